@@ -1,57 +1,293 @@
 ﻿import os
 import sys
+import re
+import json
+import base64
+import shutil
+import threading
 import subprocess
-import mimetypes
-from PySide6.QtWidgets import *
-from PySide6.QtCore import *
-from PySide6.QtGui import *
+from collections import deque
+import socket
+import http.client
+from html.parser import HTMLParser
+from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
+                               QComboBox, QProgressBar, QTextEdit, QFileDialog, QMessageBox)
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QSettings, Signal, Qt
+from PySide6.QtGui import QAction
+
+class PandocServerError(Exception):
+    pass
+
+
+class PandocServer:
+    BINARY_FORMATS = ['epub', 'docx']
+    # Outputs where the CLI fetches and embeds referenced images; the server has no filesystem access
+    EMBEDDING_FORMATS = ['pdf', 'docx']
+
+    VERSION_PATTERN = re.compile(r'"?\d+(\.\d+)+"?')
+
+    def __init__(self, timeout=3600):
+        self.port = None
+        self.timeout = timeout
+        self.process = None
+        self.started = False
+        self.verified = False
+        self.local = threading.local()
+
+    def find_free_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def start(self):
+        self.started = True
+        try:
+            self.port = self.find_free_port()
+            command = ['pandoc', 'server', f'--port={self.port}', f'--timeout={self.timeout}']
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f'Error starting Pandoc server: {str(e)}')
+            self.process = None
+
+    def ensure_started(self):
+        # Only try once, so a pandoc without server support isn't respawned on every conversion
+        if not self.started:
+            self.start()
+
+    def stop(self):
+        process = self.process
+        self.process = None
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    def is_running(self):
+        # Read once, since stop() may clear it from the UI thread while workers check it
+        process = self.process
+        return process is not None and process.poll() is None
+
+    def supports(self, input_format, output_format):
+        return output_format not in self.EMBEDDING_FORMATS
+
+    def connection(self):
+        # HTTPConnection is not thread safe, so keep one keep-alive connection per worker
+        if not hasattr(self.local, 'connection'):
+            # Outlast the server's own timeout so slow conversions aren't redone through the CLI
+            self.local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout + 60)
+        return self.local.connection
+
+    def drop_connection(self):
+        self.local.connection.close()
+        del self.local.connection
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+                return response, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closes idle keep-alive connections, so retry once on a fresh one
+                self.drop_connection()
+                if attempt:
+                    raise
+            except (OSError, http.client.HTTPException):
+                self.drop_connection()
+                raise
+
+    def verify(self):
+        # Make sure the port is answered by our pandoc server before sending it any document
+        response, data = self.request('GET', '/version')
+        version = data.decode(errors='replace').strip()
+        if response.status != 200 or not self.VERSION_PATTERN.fullmatch(version) or not self.is_running():
+            raise PandocServerError(f'Unexpected response from Pandoc server port {self.port}')
+        self.verified = True
+
+    def convert(self, input_file, output_file, input_format, output_format):
+        if input_format in self.BINARY_FORMATS:
+            with open(input_file, 'rb') as f:
+                text = base64.b64encode(f.read()).decode('ascii')
+        else:
+            # Strip a leading BOM the way the pandoc CLI does
+            with open(input_file, encoding='utf-8-sig') as f:
+                text = f.read()
+
+        if not self.verified:
+            self.verify()
+
+        body = json.dumps({'text': text, 'from': input_format, 'to': output_format})
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        response, data = self.request('POST', '/', body, headers)
+        if response.status != 200:
+            raise PandocServerError(f'Pandoc server error ({response.status}): {data.decode(errors="replace")}')
+
+        try:
+            result = json.loads(data)
+        except ValueError as e:
+            raise PandocServerError(f'Invalid Pandoc server response: {str(e)}')
+        if result.get('error'):
+            raise PandocServerError(result['error'])
+
+        if result.get('base64'):
+            with open(output_file, 'wb') as f:
+                f.write(base64.b64decode(result['output']))
+        else:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write(result['output'])
+
+        return '\n'.join(message.get('message', '') for message in result.get('messages', []))
+
+
+class HTMLTextExtractor(HTMLParser):
+    SKIPPED_TAGS = {'head', 'title', 'script', 'style', 'template'}
+    BLOCK_TAGS = {'p', 'div', 'section', 'article', 'header', 'footer', 'nav', 'aside', 'blockquote', 'pre',
+                  'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'table', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    LINE_BREAK_TAGS = {'br', 'hr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.LINE_BREAK_TAGS and not self.skip_depth:
+            self.parts.append('\n')
 
-class ConversionThread(QThread):
-    progress = Signal(int)
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in self.BLOCK_TAGS and not self.skip_depth:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def text(self):
+        text = re.sub(r'[ \t]+\n', '\n', ''.join(self.parts))
+        return re.sub(r'\n{3,}', '\n\n', text).strip() + '\n'
+
+
+def copy_file(input_file, output_file):
+    # Converting a file onto itself with an identity pair leaves nothing to do
+    if os.path.exists(output_file) and os.path.samefile(input_file, output_file):
+        return
+    shutil.copyfile(input_file, output_file)
+
+
+def strip_html_tags(input_file, output_file):
+    parser = HTMLTextExtractor()
+    with open(input_file, encoding='utf-8-sig') as f:
+        parser.feed(f.read())
+    parser.close()
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(parser.text())
+
+
+class ConversionSignals(QObject):
     finished = Signal(bool)
     error = Signal(str)
     output = Signal(str)
 
-    def __init__(self, input_file, output_file, input_format, output_format, pdf_engine):
+
+class ConversionJob(QRunnable):
+    # Conversions simple enough to do in-process without spawning pandoc
+    FAST_CONVERTERS = {
+        ('md', 'txt'): copy_file,
+        ('txt', 'md'): copy_file,
+        ('html', 'txt'): strip_html_tags,
+        ('docx', 'docx'): copy_file,
+        ('md', 'md'): copy_file,
+        ('html', 'html'): copy_file,
+        ('txt', 'txt'): copy_file,
+    }
+
+    def __init__(self, signals, input_file, output_file, input_format, output_format, pdf_engine, server=None):
         super().__init__()
+        # QRunnable is not a QObject, so signals live on a shared sidecar object
+        self.signals = signals
         self.input_file = input_file
         self.output_file = output_file
         self.input_format = input_format
         self.output_format = output_format
         self.pdf_engine = pdf_engine
+        self.server = server
+
+    def build_command(self):
+        command = ['pandoc', '-f', self.input_format, '-t', self.output_format, '-o', self.output_file, self.input_file]
+
+        if self.output_format == 'pdf':
+            command.insert(1, f'--pdf-engine={self.pdf_engine}')
+
+        return command
+
+    def convert(self):
+        fast_converter = self.FAST_CONVERTERS.get((self.input_format, self.output_format))
+        if fast_converter is not None:
+            fast_converter(self.input_file, self.output_file)
+            return
+
+        if self.server is not None and self.server.is_running() and self.server.supports(self.input_format, self.output_format):
+            try:
+                messages = self.server.convert(self.input_file, self.output_file, self.input_format, self.output_format)
+                if messages:
+                    self.signals.output.emit(messages)
+                return
+            except (OSError, http.client.HTTPException, PandocServerError) as e:
+                # Server not reachable (yet) or failed the conversion, fall back to a one-off pandoc process
+                print(f'Pandoc server unavailable, falling back to CLI: {str(e)}')
+
+        command = self.build_command()
+        # Stream output as it arrives, keeping only the tail for error reporting
+        recent = deque(maxlen=20)
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
+                              encoding='utf-8', errors='replace') as process:
+            for line in process.stdout:
+                line = line.rstrip('\n')
+                recent.append(line)
+                self.signals.output.emit(line)
+            process.wait()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, output='\n'.join(recent))
 
     def run(self):
         try:
-            command = ['pandoc', '-f', self.input_format, '-t', self.output_format, '-o', self.output_file, self.input_file]
-            
-            if self.output_format == 'pdf':
-                command.insert(1, f'--pdf-engine={self.pdf_engine}')
-                
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.progress.emit(50)
-            stdout, stderr = process.communicate()
-
-            if process.returncode != 0:
-                raise subprocess.CalledProcessError(process.returncode, command, output=stderr)
-            
-            self.progress.emit(100)
-            self.output.emit(stdout.decode())
-            self.finished.emit(True)
+            self.convert()
+            self.signals.finished.emit(True)
+        except subprocess.CalledProcessError as e:
+            self.signals.error.emit(f'{e}\n{e.output}')
+            self.signals.finished.emit(False)
         except Exception as e:
-            self.error.emit(str(e))
-            self.finished.emit(False)
+            self.signals.error.emit(str(e))
+            self.signals.finished.emit(False)
 
 
 class FileConverter(QMainWindow):
     SUPPORTED_INPUT_FORMATS = ['epub', 'docx', 'md', 'html', 'txt']
     SUPPORTED_OUTPUT_FORMATS = ['pdf', 'docx', 'html', 'md', 'txt']
     SUPPORTED_PDF_ENGINES = ['pdflatex', 'xelatex', 'lualatex']
+    _SUPPORTED_INPUT_SET = frozenset(SUPPORTED_INPUT_FORMATS)
+    _FILE_FILTER = f"Supported files ({' '.join('*.' + f for f in SUPPORTED_INPUT_FORMATS)});;All files (*.*)"
 
     def __init__(self):
         super().__init__()
         self.pdf_engine = 'xelatex'
         self.bulk_conversion = False
+        self.settings = QSettings('QConvert', 'QConvert')
+        self.total_jobs = 0
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        QThreadPool.globalInstance().setMaxThreadCount(os.cpu_count() or 1)
+        self._signals = ConversionSignals()
+        self._signals.finished.connect(self.on_conversion_finished)
+        self._signals.error.connect(self.on_conversion_error)
+        self._signals.output.connect(self.append_output)
         self.initUI()
+        self.pandoc_server = PandocServer()
 
     def initUI(self):
         self.setWindowTitle('File Converter')
@@ -155,8 +391,7 @@ class FileConverter(QMainWindow):
             else:
                 self.file_label.setText('No directory selected')
         else:
-            file_filter = 'Supported files (*.epub *.docx *.md *.html *.txt);;All files (*.*)'
-            self.input_file, _ = QFileDialog.getOpenFileName(self, 'Select File', '', file_filter)
+            self.input_file, _ = QFileDialog.getOpenFileName(self, 'Select File', '', self._FILE_FILTER)
             if self.input_file:
                 self.file_label.setText(os.path.basename(self.input_file))
                 self.detect_file_type()
@@ -164,15 +399,11 @@ class FileConverter(QMainWindow):
                 self.file_label.setText('No file selected')
 
     def detect_file_type(self):
-        mime_type, _ = mimetypes.guess_type(self.input_file)
-        if mime_type:
-            file_extension = os.path.splitext(self.input_file)[1][1:].lower()
-            if file_extension in self.SUPPORTED_INPUT_FORMATS:
-                self.input_format_combo.setCurrentText(file_extension)
-            else:
-                QMessageBox.warning(self, 'Unsupported File', 'The selected file type is not supported.')
+        file_extension = os.path.splitext(self.input_file)[1][1:].lower()
+        if file_extension in self._SUPPORTED_INPUT_SET:
+            self.input_format_combo.setCurrentText(file_extension)
         else:
-            QMessageBox.warning(self, 'File Type Detection Failed', 'Could not detect the file type.')
+            QMessageBox.warning(self, 'Unsupported File', 'The selected file type is not supported.')
 
     def convert_file(self):
         if self.bulk_conversion:
@@ -185,8 +416,7 @@ class FileConverter(QMainWindow):
             QMessageBox.warning(self, 'Error', 'Please select a file to convert.')
             return
         
-        parsed_input_file = self.input_file.split('.')[:-1]
-        joined_input_file = '.'.join(parsed_input_file)
+        joined_input_file = os.path.splitext(self.input_file)[0]
         input_format = self.input_format_combo.currentText()
         output_format = self.output_format_combo.currentText()
         output_file = QFileDialog.getSaveFileName(self, 'Save File', f'{joined_input_file}.{output_format}', f'*.{output_format}')[0]
@@ -195,13 +425,7 @@ class FileConverter(QMainWindow):
             QMessageBox.warning(self, 'Error', 'Please specify an output file.')
             return
 
-        self.progress_bar.setValue(0)
-        self.thread = ConversionThread(self.input_file, output_file, input_format, output_format, self.pdf_engine)
-        self.thread.progress.connect(self.update_progress)
-        self.thread.finished.connect(self.on_conversion_finished)
-        self.thread.error.connect(self.on_conversion_error)
-        self.thread.output.connect(self.append_output)
-        self.thread.start()
+        self.start_conversion([(self.input_file, output_file)], input_format, output_format)
 
     def convert_bulk_files(self):
         if not hasattr(self, 'input_directory') or not self.input_directory:
@@ -210,31 +434,62 @@ class FileConverter(QMainWindow):
         
         input_format = self.input_format_combo.currentText()
         output_format = self.output_format_combo.currentText()
+        suffix = '.' + input_format.lower()
+        output_suffix = '.' + output_format
+        jobs = [(input_file, os.path.splitext(input_file)[0] + output_suffix)
+                for input_file in self._iter_matching(self.input_directory, suffix)]
+
+        if not jobs:
+            QMessageBox.warning(self, 'Error', f'No .{input_format} files found in the selected directory.')
+            return
+
+        self.start_conversion(jobs, input_format, output_format)
+
+    def start_conversion(self, jobs, input_format, output_format):
         self.progress_bar.setValue(0)
-        self.progress = 0
-        for root, _, files in os.walk(self.input_directory):
-            for file in files:
-                if file.lower().endswith(f'.{input_format}'):
-                    input_file = os.path.join(root, file)
-                    parsed_input_file = input_file.split('.')[:-1]
-                    joined_input_file = '.'.join(parsed_input_file)
-                    output_file = os.path.join(root, f'{joined_input_file}.{output_format}')
-                    #self.progress += 10
-                    #self.progress_bar.setValue(self.progress)
-                    self.thread = ConversionThread(input_file, output_file, input_format, output_format, self.pdf_engine)
-                    self.thread.progress.connect(self.update_progress)
-                    self.thread.finished.connect(self.on_conversion_finished)
-                    self.thread.error.connect(self.on_conversion_error)
-                    self.thread.output.connect(self.append_output)
-                    self.thread.start()
-                    self.thread.wait()  # Wait for the current file conversion to finish before starting the next
-        self.progress_bar.setValue(100)
-                    
+        self.convert_button.setEnabled(False)
+        self.total_jobs = len(jobs)
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        self.pandoc_server.ensure_started()
+        pool = QThreadPool.globalInstance()
+        for input_file, output_file in jobs:
+            pool.start(ConversionJob(self._signals, input_file, output_file, input_format, output_format, self.pdf_engine, self.pandoc_server))
+
+    def _iter_matching(self, root, suffix):
+        # scandir reuses the d_type from readdir, avoiding a stat per entry
+        try:
+            entries = os.scandir(root)
+        except OSError as e:
+            # Skip unreadable or vanished directories, as os.walk does
+            print(f'Skipping directory {root}: {str(e)}')
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._iter_matching(entry.path, suffix)
+                elif entry.is_file() and entry.name.lower().endswith(suffix):
+                    yield entry.path
+
+    def closeEvent(self, event):
+        # Drop queued jobs so shutdown doesn't keep converting without a window
+        QThreadPool.globalInstance().clear()
+        self.pandoc_server.stop()
+        super().closeEvent(event)
+
     def update_progress(self, value):
         self.progress_bar.setValue(value)
 
     def on_conversion_finished(self, success):
-        if success:
+        self.completed_jobs += 1
+        if not success:
+            self.failed_jobs += 1
+        self.update_progress(int(self.completed_jobs / self.total_jobs * 100))
+        if self.completed_jobs < self.total_jobs:
+            return
+
+        self.convert_button.setEnabled(True)
+        if not self.failed_jobs:
             QMessageBox.information(self, 'Conversion Complete', 'File converted successfully.')
         else:
             QMessageBox.critical(self, 'Conversion Failed', 'An error occurred during conversion.')
@@ -246,10 +501,25 @@ class FileConverter(QMainWindow):
     def append_output(self, output_message):
         self.output_text.append(output_message)
 
+    def tool_cache_key(self, tool):
+        path = shutil.which(tool)
+        if path is None:
+            return None
+        return f'{path}:{os.path.getmtime(path)}'
+
     def check_pdflatex_installed(self):
+        key = self.tool_cache_key('pdflatex')
+        if key is None:
+            print('Error checking pdflatex version: pdflatex not found')
+            print(f'System PATH: {os.environ["PATH"]}')
+            return False
+        if self.settings.value('pdflatex_ok_for_path', '') == key:
+            return True
+
         try:
-            result = subprocess.run(['pdflatex', '--version'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            print(f'pdflatex version check output: {result.stdout.decode()}')
+            subprocess.run(['pdflatex', '--version'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            print('pdflatex version check passed')
+            self.settings.setValue('pdflatex_ok_for_path', key)
             return True
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             print(f'Error checking pdflatex version: {str(e)}')
@@ -257,9 +527,18 @@ class FileConverter(QMainWindow):
             return False
         
     def check_pandoc_installed(self):
+        key = self.tool_cache_key('pandoc')
+        if key is None:
+            print('Error checking Pandoc version: pandoc not found')
+            print(f'System PATH: {os.environ["PATH"]}')
+            return False
+        if self.settings.value('pandoc_ok_for_path', '') == key:
+            return True
+
         try:
-            result = subprocess.run(['pandoc', '--version'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            print(f'Pandoc version check output: {result.stdout.decode()}')
+            subprocess.run(['pandoc', '--version'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            print('Pandoc version check passed')
+            self.settings.setValue('pandoc_ok_for_path', key)
             return True
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             print(f'Error checking Pandoc version: {str(e)}')